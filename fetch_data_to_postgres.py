@@ -1,18 +1,111 @@
-from openaq import OpenAQ
-import pandas as pd
+import asyncio
+import math
+import ciso8601
+import hishel
+import httpcore
+import httpx
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from pgcopy import CopyManager
 from dateutil import parser
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 
 load_dotenv()
 api_key = os.getenv("OPENAQ_API_KEY")
 database_url = os.getenv("DATABASE_URL")
 
-client = OpenAQ(api_key=api_key)
+API_BASE_URL = "https://api.openaq.org/v3"
+PAGE_LIMIT = 1000
+MAX_CONCURRENT_SENSORS = 10
+MAX_CONCURRENT_PAGES = 8
+PAGE_QUEUE_SIZE = 16
+
+# Transient failures are retried with exponential backoff (0.5s, 1s, 2s, ...);
+# rate-limited requests wait until the server's limit resets instead
+RETRY_ATTEMPTS = 5
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+BACKOFF = wait_exponential(multiplier=0.5)
+RATE_LIMIT_FALLBACK_SECONDS = 60
+
+# Daily aggregates for past dates never change, so responses for windows
+# that end before today are kept on disk for a day and reruns are served
+# from the cache
+CACHE_DIR = "openaq_cache"
+CACHE_TTL_SECONDS = 86400
+
+# Fields kept from each API result; pyarrow ignores all other keys.
+RESULT_TYPE = pa.struct([
+    ('parameter', pa.struct([('name', pa.string()), ('units', pa.string())])),
+    ('period', pa.struct([
+        ('datetimeFrom', pa.struct([('utc', pa.string()), ('local', pa.string())])),
+    ])),
+    ('value', pa.float64()),
+    ('coverage', pa.struct([('percentComplete', pa.float64())])),
+    ('summary', pa.struct([
+        ('min', pa.float64()), ('max', pa.float64()), ('median', pa.float64()),
+    ])),
+])
+
+# Dotted path into RESULT_TYPE for every SCHEMA column except sensor_id
+RESULT_PATHS = {
+    'parameter': 'parameter.name',
+    'datetime_utc': 'period.datetimeFrom.utc',
+    'datetime_local': 'period.datetimeFrom.local',
+    'value': 'value',
+    'units': 'parameter.units',
+    'coverage_percent': 'coverage.percentComplete',
+    'min_value': 'summary.min',
+    'max_value': 'summary.max',
+    'median_value': 'summary.median',
+}
 
+# One dateutil parser for the whole process
+DATEUTIL_PARSER = parser.parser()
 
+# datetime_local stays a string so the station's UTC offset is kept.
+SCHEMA = pa.schema([
+    ('sensor_id', pa.int32()),
+    ('parameter', pa.dictionary(pa.int32(), pa.string())),
+    ('datetime_utc', pa.timestamp('s', tz='UTC')),
+    ('datetime_local', pa.string()),
+    ('value', pa.float32()),
+    ('units', pa.dictionary(pa.int32(), pa.string())),
+    ('coverage_percent', pa.float32()),
+    ('min_value', pa.float32()),
+    ('max_value', pa.float32()),
+    ('median_value', pa.float32()),
+])
+
+# Same DDL as init.sql, which only runs when Docker creates an empty volume
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS air_quality_measurements (
+    sensor_id        INTEGER,
+    parameter        TEXT,
+    datetime_utc     TIMESTAMPTZ,
+    datetime_local   TIMESTAMPTZ,
+    value            REAL,
+    units            TEXT,
+    coverage_percent REAL,
+    min_value        REAL,
+    max_value        REAL,
+    median_value     REAL
+)
+"""
+
+
+@lru_cache(maxsize=256)
 def parse_date_to_openaq_format(date_input):
     """Convert various date formats to OpenAQ API format."""
     if date_input is None:
@@ -22,112 +115,338 @@ def parse_date_to_openaq_format(date_input):
     if isinstance(date_input, str) and date_input.endswith('Z'):
         return date_input
     try:
-        dt = parser.parse(date_input, dayfirst=False)
+        # ciso8601 handles ISO 8601 in C; dateutil only for fuzzy formats
+        try:
+            dt = ciso8601.parse_datetime(date_input)
+        except ValueError:
+            dt = DATEUTIL_PARSER.parse(date_input, dayfirst=False)
         return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
     except Exception as e:
         raise ValueError(f"Could not parse date '{date_input}'. Error: {e}")
 
 
-def get_sensor_data(client, sensor_id, datetime_from="2020-01-01", datetime_to="2025-01-01"):
-    """Fetch data for a single sensor."""
-    datetime_from = parse_date_to_openaq_format(datetime_from)
-    datetime_to = parse_date_to_openaq_format(datetime_to)
+class KeylessSerializer(hishel.JSONSerializer):
+    """hishel JSON serializer that keeps the X-API-Key header out of the cache files."""
+    def dumps(self, response, request, metadata):
+        request = httpcore.Request(
+            method=request.method,
+            url=request.url,
+            headers=[(k, v) for k, v in request.headers if k.lower() != b"x-api-key"],
+            extensions=request.extensions,
+        )
+        return super().dumps(response, request, metadata)
+
+
+def create_client():
+    """Build the shared, disk-cached HTTP/2 client for the OpenAQ v3 API."""
+    transport = hishel.AsyncCacheTransport(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        ),
+        storage=hishel.AsyncFileStorage(
+            serializer=KeylessSerializer(),
+            base_path=Path(CACHE_DIR),
+            ttl=CACHE_TTL_SECONDS,
+        ),
+    )
+    return httpx.AsyncClient(
+        base_url=API_BASE_URL,
+        headers={"X-API-Key": api_key},
+        transport=transport,
+        timeout=30.0,
+    )
+
+
+def is_transient(exc):
+    """Whether a failed request is worth retrying (network blips, 429, 5xx gateways)."""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUS_CODES
+    return isinstance(exc, httpx.TransportError)
+
+
+def retry_wait(retry_state):
+    """Honor Retry-After / x-ratelimit-reset on 429; otherwise back off exponentially."""
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        headers = exc.response.headers
+        delay = headers.get("Retry-After") or headers.get("x-ratelimit-reset")
+        try:
+            return max(float(delay), 0.0)
+        except (TypeError, ValueError):
+            return RATE_LIMIT_FALLBACK_SECONDS
+    return BACKOFF(retry_state)
+
+
+@retry(
+    retry=retry_if_exception(is_transient),
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    wait=retry_wait,
+    reraise=True,
+)
+async def fetch_page(client, sensor_id, page, date_from, date_to):
+    """Fetch one page of daily measurements for a sensor."""
+    response = await client.get(
+        f"/sensors/{sensor_id}/days",
+        params={
+            "date_from": date_from,
+            "date_to": date_to,
+            "limit": PAGE_LIMIT,
+            "page": page,
+        },
+        # Only a window that ends before today is final; anything touching
+        # today is left to the normal cache rules so it is refetched
+        extensions={"force_cache": date_to < datetime.now(timezone.utc).date().isoformat()},
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+def struct_field(array, path):
+    """Pull a nested child out of a StructArray by dotted path, keeping parent nulls."""
+    for name in path.split('.'):
+        array = array.flatten()[array.type.get_field_index(name)]
+    return array
+
+
+def results_to_batch(sensor_id, results):
+    """Convert one page of API results into a RecordBatch matching SCHEMA."""
+    rows = pa.array(results, type=RESULT_TYPE)
+    
+    arrays = []
+    for field in SCHEMA:
+        if field.name == 'sensor_id':
+            arrays.append(pa.repeat(pa.scalar(sensor_id, field.type), len(rows)))
+            continue
+        
+        column = struct_field(rows, RESULT_PATHS[field.name])
+        if pa.types.is_dictionary(field.type):
+            # parameter/units have a handful of distinct values
+            column = column.dictionary_encode()
+        elif pa.types.is_floating(field.type):
+            # JSON numbers come in as float64, since a large integer does not
+            # convert to float32 directly; the narrowing may round
+            column = column.cast(field.type, safe=False)
+        elif column.type != field.type:
+            # datetime_utc is cast from its ISO form to a timestamp
+            column = column.cast(field.type)
+        arrays.append(column)
+    
+    return pa.RecordBatch.from_arrays(arrays, schema=SCHEMA)
+
+
+def pages_from_found(found):
+    """Number of pages implied by ``meta.found``; None when it is inexact (">1000")."""
+    if isinstance(found, int):
+        return math.ceil(found / PAGE_LIMIT)
+    return None
+
+
+async def fetch_window(client, sensor_id, pages, date_from, date_to):
+    """Fetch several pages concurrently; one failure cancels the rest and is re-raised."""
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tasks = [
+                tg.create_task(fetch_page(client, sensor_id, page, date_from, date_to))
+                for page in pages
+            ]
+    except ExceptionGroup:
+        # Raise the first failed page's own exception, tagged with its page
+        for page, task in zip(pages, tasks):
+            if not task.cancelled() and task.exception() is not None:
+                exc = task.exception()
+                exc.page = page
+                raise exc from None
+        raise
+    return [task.result() for task in tasks]
+
+
+async def get_sensor_data(client, sensor_id, output_file, datetime_from="2020-01-01", datetime_to="2025-01-01"):
+    """Stream data for a single sensor into a Parquet file as pages arrive."""
+    # The days endpoint filters on whole dates (date_from/date_to), not
+    # on datetime_from/datetime_to
+    date_from = parse_date_to_openaq_format(datetime_from)[:10]
+    date_to = parse_date_to_openaq_format(datetime_to)[:10]
     
-    all_data = []
+    # Pages go to a temporary name that only a complete history replaces
+    partial_file = output_file + ".part"
+    writer = None
+    total = 0
+    complete = False
     page = 1
     
     print(f"\nFetching data for sensor {sensor_id}...")
     
-    while True:
+    queue = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+    
+    def write_page(page_number, results):
+        nonlocal writer, total
+        if not results:
+            return
+        batch = results_to_batch(sensor_id, results)
+        if writer is None:
+            writer = pq.ParquetWriter(partial_file, SCHEMA)
+        writer.write_batch(batch)
+        total += batch.num_rows
+        print(f"  Sensor {sensor_id} page {page_number}: {len(results)} records")
+    
+    async def produce():
+        # Fetch pages eagerly and hand them over in page order; a None
+        # sentinel tells the consumer there is nothing more to come
+        nonlocal page
         try:
-            response = client.measurements.list(
-                sensors_id=sensor_id,
-                datetime_from=datetime_from,
-                datetime_to=datetime_to,
-                data="days",
-                limit=1000,
-                page=page
-            )
-            
-            if not response.results:
-                break
+            data = await fetch_page(client, sensor_id, page, date_from, date_to)
+            n_pages = pages_from_found(data['meta'].get('found'))
             
-            for result in response.results:
-                all_data.append({
-                    'sensor_id': sensor_id,
-                    'parameter': result.parameter.name,
-                    'datetime_utc': result.period.datetime_from.utc,
-                    'datetime_local': result.period.datetime_from.local,
-                    'value': result.value,
-                    'units': result.parameter.units,
-                    'coverage_percent': result.coverage.percent_complete if result.coverage else None,
-                    'min_value': result.summary.min if result.summary else None,
-                    'max_value': result.summary.max if result.summary else None,
-                    'median_value': result.summary.median if result.summary else None,
-                })
-            
-            print(f"  Page {page}: {len(response.results)} records")
-            
-            if len(response.results) < 1000:
-                break
-            
-            page += 1
+            if n_pages == 0:
+                # meta.found says the window is empty: one request is enough
+                print(f"  No measurements between {date_from} and {date_to}")
+            elif n_pages is None:
+                # Unknown total: walk the pages one at a time
+                while data['results']:
+                    await queue.put((page, data['results']))
+                    
+                    if len(data['results']) < PAGE_LIMIT:
+                        break
+                    
+                    page += 1
+                    data = await fetch_page(client, sensor_id, page, date_from, date_to)
+            else:
+                # Known total: fetch the remaining pages MAX_CONCURRENT_PAGES
+                # at a time
+                await queue.put((page, data['results']))
+                for start in range(2, n_pages + 1, MAX_CONCURRENT_PAGES):
+                    window = range(start, min(start + MAX_CONCURRENT_PAGES, n_pages + 1))
+                    pages = await fetch_window(client, sensor_id, window, date_from, date_to)
+                    for page, data in zip(window, pages):
+                        await queue.put((page, data['results']))
             
         except Exception as e:
-            print(f"  Error on page {page}: {e}")
-            break
+            # Transient errors were already retried; fail the sensor rather
+            # than report a truncated history as complete
+            print(f"  Sensor {sensor_id}: error on page {getattr(e, 'page', page)}: {e}")
+            await queue.put(None)
+            raise
+        
+        await queue.put(None)
     
-    df = pd.DataFrame(all_data)
-    print(f"✓ Collected {len(df)} records")
-    return df
+    # The producer runs as its own task while this coroutine consumes, so
+    # the next requests are in flight while a page is being converted
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            write_page(*item)
+        await producer
+        complete = True
+    finally:
+        producer.cancel()
+        if writer is not None:
+            writer.close()
+            if complete:
+                os.replace(partial_file, output_file)
+            else:
+                os.remove(partial_file)
+    
+    print(f"✓ Collected {total} records")
+    return total
 
 
-def save_to_postgres(df):
-    """Save DataFrame to PostgreSQL."""
-    if df.empty:
-        print("⚠️  Empty DataFrame, nothing to save")
+async def fetch_sensor(sem, client, sensor_id, datetime_from, datetime_to):
+    """Fetch a sensor while holding one slot of the concurrency semaphore."""
+    async with sem:
+        return await get_sensor_data(
+            client, sensor_id, f"sensor_data/sensor_{sensor_id}.parquet",
+            datetime_from, datetime_to
+        )
+
+
+def column_to_pylist(column):
+    """Like Array.to_pylist(), but dictionary columns share one str per distinct value."""
+    if not pa.types.is_dictionary(column.type):
+        return column.to_pylist()
+    values = column.dictionary.to_pylist()
+    return [values[i] if i is not None else None for i in column.indices.to_pylist()]
+
+
+def batch_to_records(batch):
+    """Turn a RecordBatch into row tuples of the Python types pgcopy encodes."""
+    columns = [column_to_pylist(column) for column in batch.columns]
+    
+    # Binary COPY sends timestamps, not text, so the local ISO string
+    # (with its UTC offset) is parsed here
+    local = SCHEMA.get_field_index('datetime_local')
+    columns[local] = [datetime.fromisoformat(s) if s else None for s in columns[local]]
+    
+    return zip(*columns)
+
+
+def save_to_postgres(parquet_file):
+    """Bulk-load a sensor's Parquet file into PostgreSQL with binary COPY."""
+    parquet = pq.ParquetFile(parquet_file)
+    if parquet.metadata.num_rows == 0:
+        print("⚠️  Empty Parquet file, nothing to save")
         return
     
     engine = create_engine(database_url)
     
-    # Convert datetime columns
-    df['datetime_utc'] = pd.to_datetime(df['datetime_utc'])
-    df['datetime_local'] = pd.to_datetime(df['datetime_local'])
-    
+    conn = engine.raw_connection()
     try:
-        df.to_sql(
-            'air_quality_measurements', 
-            engine, 
-            if_exists='append',
-            index=False,
-            method='multi',
-            chunksize=1000
-        )
-        print(f"✓ Saved {len(df)} records to PostgreSQL")
+        # COPY does not create the table the way to_sql did
+        with conn.cursor() as cur:
+            cur.execute(CREATE_TABLE_SQL)
+        mgr = CopyManager(conn.driver_connection, 'air_quality_measurements', SCHEMA.names)
+        for batch in parquet.iter_batches():
+            mgr.copy(batch_to_records(batch))
+        conn.commit()
+        print(f"✓ Saved {parquet.metadata.num_rows} records to PostgreSQL")
     except Exception as e:
+        conn.rollback()
         print(f"✗ Error saving to database: {e}")
+    finally:
+        conn.close()
 
 
-if __name__ == '__main__':
-    print("=" * 70)
-    print("FETCHING DATA AND SAVING TO POSTGRESQL")
-    print("=" * 70)
+async def main(sensor_ids, datetime_from, datetime_to):
+    """Fetch all sensors concurrently, then save each one to PostgreSQL."""
+    os.makedirs('sensor_data', exist_ok=True)
     
-    # Test with a few sensors
-    sensor_ids = [1884, 2178, 1102]
+    sem = asyncio.Semaphore(MAX_CONCURRENT_SENSORS)
+    async with create_client() as client:
+        results = await asyncio.gather(
+            *[fetch_sensor(sem, client, sensor_id, datetime_from, datetime_to)
+              for sensor_id in sensor_ids],
+            return_exceptions=True,
+        )
     
-    for idx, sensor_id in enumerate(sensor_ids, 1):
+    for idx, (sensor_id, total) in enumerate(zip(sensor_ids, results), 1):
         print(f"\n[{idx}/{len(sensor_ids)}] Processing sensor {sensor_id}")
         print("-" * 70)
         
+        if isinstance(total, Exception):
+            print(f"✗ Error: {total}")
+            continue
+        
         try:
-            df = get_sensor_data(client, sensor_id, "1/1/2023", "12/31/2023")
-            
-            if not df.empty:
-                save_to_postgres(df)
+            if total:
+                parquet_file = f"sensor_data/sensor_{sensor_id}.parquet"
+                save_to_postgres(parquet_file)
+                os.remove(parquet_file)
             
         except Exception as e:
             print(f"✗ Error: {e}")
+
+
+if __name__ == '__main__':
+    print("=" * 70)
+    print("FETCHING DATA AND SAVING TO POSTGRESQL")
+    print("=" * 70)
+    
+    # Test with a few sensors
+    sensor_ids = [1884, 2178, 1102]
     
-    client.close()
+    run = uvloop.run if uvloop is not None else asyncio.run
+    run(main(sensor_ids, "1/1/2023", "12/31/2023"))
     print("\n✓ Complete!")
\ No newline at end of file
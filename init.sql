@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS air_quality_measurements (
+    sensor_id        INTEGER,
+    parameter        TEXT,
+    datetime_utc     TIMESTAMPTZ,
+    datetime_local   TIMESTAMPTZ,
+    value            REAL,
+    units            TEXT,
+    coverage_percent REAL,
+    min_value        REAL,
+    max_value        REAL,
+    median_value     REAL
+);